@@ -1,11 +1,46 @@
+import argparse
 import os
+import sys
 import pandas as pd
 
 # Paths
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from scripts.transform_features import CUSTOMER_SKETCH_KIND, customer_fingerprint
+from utils.logger import get_logger
+from utils.sketches import HyperLogLog, KLLSketch, load_sketch_states, merge_sketch_states
+
+logger = get_logger("export_summary")
+
 INPUT = os.path.join(PROJECT_ROOT, "data", "processed", "features", "customer_segments.csv")
 SUMMARY_OUT = os.path.join(PROJECT_ROOT, "data", "processed", "summary_metrics.csv")
 SEGMENT_OUT = os.path.join(PROJECT_ROOT, "data", "processed", "segment_summary.csv")
+CUSTOMER_SKETCHES = os.path.join(PROJECT_ROOT, "data", "processed", "features", "customer_sketches.json")
+SKETCH_SUMMARY_OUT = os.path.join(PROJECT_ROOT, "data", "processed", "sketch_summary.csv")
+
+parser = argparse.ArgumentParser(description="Export cluster and segment summary metrics.")
+parser.add_argument("--sketch", action="store_true",
+                    help="write sketch-backed distinct counts and order percentiles per cluster")
+parser.add_argument("--merge-sketches", nargs="+", default=[], metavar="PATH",
+                    help="extra customer sketch files (other shards or earlier runs) to merge in; implies --sketch")
+args = parser.parse_args()
+
+SKETCH_MODE = args.sketch or bool(args.merge_sketches)
+PERCENTILES = [0.5, 0.9, 0.99]
+
+
+def load_customer_sketches(path):
+    states, metadata = load_sketch_states(path)
+    if metadata.get("kind") != CUSTOMER_SKETCH_KIND:
+        raise ValueError(f"{path} does not hold customer sketch states (kind: {metadata.get('kind')!r})")
+    return states, metadata
+
+
+def source_fingerprint(metadata):
+    return metadata["source"], metadata["source_mtime"], metadata["num_rows"]
+
 
 # Load data
 df = pd.read_csv(INPUT)
@@ -32,6 +67,76 @@ cluster_summary = df.groupby("Cluster").agg(**{
     new_name: (col, func) for col, func, new_name in agg_list
 }).reset_index()
 
+# Sketch-backed cluster metrics. Only per-customer states are merged across
+# chunks, shards and runs; cluster states are rebuilt from this run's labels,
+# since KMeans labels are not stable between runs.
+if SKETCH_MODE:
+    if not os.path.exists(CUSTOMER_SKETCHES):
+        raise FileNotFoundError(
+            f"Customer sketch states not found at {CUSTOMER_SKETCHES}. Run `python main.py --sketch` first."
+        )
+    customer_states, metadata = load_customer_sketches(CUSTOMER_SKETCHES)
+    customer_keys = set(df["CustomerID"].astype(int).astype(str))
+    if metadata["customers"] != customer_fingerprint(customer_keys):
+        raise ValueError(
+            f"{CUSTOMER_SKETCHES} was built for different customers than {INPUT}. "
+            "Re-run `python main.py --sketch` to refresh it."
+        )
+    if not os.path.exists(metadata["source"]):
+        logger.warning(f"Raw data {metadata['source']} not found; cannot check the sketch states are current.")
+    elif os.path.getmtime(metadata["source"]) != metadata["source_mtime"]:
+        raise ValueError(
+            f"{metadata['source']} changed after {CUSTOMER_SKETCHES} was built. "
+            "Re-run `python main.py --sketch` to refresh it."
+        )
+    last_purchase_day = metadata["last_purchase_day"]
+
+    # Customers outside this run's segments have no cluster, so only their
+    # counterparts in df are merged from the extra files
+    seen_sources = {source_fingerprint(metadata)}
+    for path in args.merge_sketches:
+        extra_states, extra_metadata = load_customer_sketches(path)
+        if source_fingerprint(extra_metadata) in seen_sources:
+            raise ValueError(
+                f"{path} was built from the same data as another sketch file; "
+                "merging it would count its transactions twice."
+            )
+        seen_sources.add(source_fingerprint(extra_metadata))
+
+        shared = customer_keys & set(extra_states)
+        if not shared:
+            raise ValueError(f"{path} has no customers in common with {INPUT}.")
+        merge_sketch_states(customer_states, {key: extra_states[key] for key in shared})
+        last_purchase_day = max(last_purchase_day, extra_metadata["last_purchase_day"])
+        logger.info(f"Merged customer sketch states for {len(shared)} customers from {path}")
+
+    sketch_rows = []
+    for cluster, group in df.groupby("Cluster"):
+        state = {
+            "Invoices": HyperLogLog(),
+            "Products": HyperLogLog(),
+            "OrderValue": KLLSketch(seed=0),
+            "PurchaseDay": KLLSketch(seed=0),
+        }
+        for key in group["CustomerID"].astype(int).astype(str):
+            for name, sketch in state.items():
+                sketch.merge(customer_states[key][name])
+
+        row = {
+            "Cluster": cluster,
+            "Num_Customers": len(group),
+            "Num_Sources": 1 + len(args.merge_sketches),
+            "Distinct_Invoices": state["Invoices"].count(),
+            "Distinct_Products": state["Products"].count(),
+        }
+        for q in PERCENTILES:
+            row[f"OrderValue_p{int(q * 100)}"] = state["OrderValue"].quantile(q)
+        for q in PERCENTILES:
+            # A high recency percentile is a low purchase-day percentile
+            row[f"PurchaseRecency_p{int(q * 100)}"] = last_purchase_day - state["PurchaseDay"].quantile(1 - q)
+        sketch_rows.append(row)
+    sketch_summary = pd.DataFrame(sketch_rows)
+
 # Segment-level summary (if column exists)
 if "Segment" in df.columns:
     segment_summary = df.groupby("Segment").agg(
@@ -45,9 +150,14 @@ else:
 os.makedirs(os.path.dirname(SUMMARY_OUT), exist_ok=True)
 cluster_summary.to_csv(SUMMARY_OUT, index=False)
 segment_summary.to_csv(SEGMENT_OUT, index=False)
+if SKETCH_MODE:
+    sketch_summary.to_csv(SKETCH_SUMMARY_OUT, index=False)
 
 print("Cluster summary saved to:", SUMMARY_OUT)
 print(cluster_summary)
+if SKETCH_MODE:
+    print("\nSketch summary saved to:", SKETCH_SUMMARY_OUT)
+    print(sketch_summary)
 if not segment_summary.empty:
     print("\nSegment summary saved to:", SEGMENT_OUT)
     print(segment_summary)
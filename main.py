@@ -36,10 +36,14 @@ REDSHIFT_PASSWORD = "hihello@24"
 # --- Paths ---
 RAW_FILE = os.path.join(project_root, "data", "raw", "ecommerce_data.csv")
 FEATURE_FILE = os.path.join(project_root, "data", "processed", "features", "customer_features.csv")
+SKETCH_FILE = os.path.join(project_root, "data", "processed", "features", "customer_sketches.json")
 SEGMENT_FILE = os.path.join(project_root, "data", "processed", "features", "customer_segments.csv")
 ELBOW_PLOT = os.path.join(project_root, "analysis", "outputs", "elbow_curve.png")
 SEGMENT_PLOT = os.path.join(project_root, "analysis", "outputs", "customer_segments.png")
 
+# Pass --sketch to also save mergeable per-customer sketch states
+SKETCH_MODE = "--sketch" in sys.argv
+
 os.makedirs(os.path.dirname(ELBOW_PLOT), exist_ok=True)
 os.makedirs(os.path.dirname(SEGMENT_PLOT), exist_ok=True)
 
@@ -50,8 +54,13 @@ def transform_data():
     try:
         df_features = transform_features.create_customer_features(
             RAW_FILE,  # path to your input CSV
-            FEATURE_FILE  # path to save processed features
+            FEATURE_FILE,  # path to save processed features
+            sketch_path=SKETCH_FILE if SKETCH_MODE else None
         )
+        if not SKETCH_MODE and os.path.exists(SKETCH_FILE):
+            # Sketch states from an older --sketch run no longer match these features
+            os.remove(SKETCH_FILE)
+            logger.info(f"Removed stale sketch states at {SKETCH_FILE}")
         logger.info("Data transformation completed successfully.")
         return df_features
     except Exception as e:
@@ -1,11 +1,52 @@
+import hashlib
+import os
 import pandas as pd
 import logging
 from datetime import datetime
+from utils.sketches import HyperLogLog, KLLSketch, save_sketch_states
 
-def create_customer_features(raw_data_path, output_path):
+EPOCH = pd.Timestamp('1970-01-01')
+CUSTOMER_SKETCH_KIND = 'customer_sketches'
+
+
+def customer_fingerprint(customer_keys):
+    """
+    Hash of the sorted customer keys, used to tell whether a sketch file
+    was built for the same customers as a features or segments file.
+    """
+    return hashlib.sha256("\n".join(sorted(customer_keys)).encode('utf-8')).hexdigest()
+
+
+def create_customer_sketches(df):
+    """
+    Builds mergeable sketches per customer: distinct invoices and products, and the
+    distributions of order values and purchase days (days since 1970-01-01).
+    States from separate chunks, shards or runs combine without the raw rows.
+    """
+    invoices = df.groupby(['CustomerID', 'InvoiceNo']).agg(
+        OrderValue=('TotalAmount', 'sum'),
+        InvoiceDate=('InvoiceDate', 'max'),
+    ).reset_index()
+    invoices['PurchaseDay'] = (invoices['InvoiceDate'] - EPOCH).dt.days
+    products = df.groupby('CustomerID')['StockCode']
+
+    states = {}
+    for customer_id, group in invoices.groupby('CustomerID'):
+        key = str(int(customer_id))
+        states[key] = {
+            'Invoices': HyperLogLog().update(group['InvoiceNo']),
+            'Products': HyperLogLog().update(products.get_group(customer_id)),
+            'OrderValue': KLLSketch(seed=int(key)).update(group['OrderValue']),
+            'PurchaseDay': KLLSketch(seed=int(key)).update(group['PurchaseDay']),
+        }
+    return states
+
+
+def create_customer_features(raw_data_path, output_path, sketch_path=None):
     """
     Reads the raw dataset, aggregates by CustomerID,
     and saves processed customer features.
+    If sketch_path is given, per-customer sketch states are saved there as well.
     """
     logging.info(f"Loading raw dataset from {raw_data_path}...")
     df = pd.read_csv(raw_data_path, encoding='latin1')
@@ -44,6 +85,20 @@ def create_customer_features(raw_data_path, output_path):
     recency['RecencyDays'] = (last_date - recency['InvoiceDate']).dt.days
     customer_features = pd.merge(customer_features, recency[['CustomerID', 'RecencyDays']], on='CustomerID')
 
+    if sketch_path:
+        logging.info("Building per-customer sketch states...")
+        customer_sketches = create_customer_sketches(df)
+        save_sketch_states(customer_sketches, sketch_path, metadata={
+            'kind': CUSTOMER_SKETCH_KIND,
+            'source': os.path.abspath(raw_data_path),
+            'source_mtime': os.path.getmtime(raw_data_path),
+            'num_rows': len(df),
+            'num_customers': len(customer_sketches),
+            'customers': customer_fingerprint(customer_sketches),
+            'last_purchase_day': int((last_date - EPOCH).days),
+        })
+        logging.info(f"Customer sketch states saved at {sketch_path}")
+
     customer_features.to_csv(output_path, index=False)
     logging.info(f"Customer features saved: {len(customer_features)} rows at {output_path}")
     logging.info("First 5 rows:")
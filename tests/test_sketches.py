@@ -0,0 +1,184 @@
+import bisect
+import json
+import math
+import os
+import random
+import sys
+
+import pytest
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from utils.sketches import HyperLogLog, KLLSketch, load_sketch_states, merge_sketch_states, save_sketch_states
+
+HLL_BOUND = 3 * 1.04 / math.sqrt(HyperLogLog().m)
+KLL_RANK_BOUND = 0.02
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def json_round_trip(sketch):
+    return type(sketch).from_dict(json.loads(json.dumps(sketch.to_dict())))
+
+
+def rank_error(sorted_values, value, q):
+    return abs(bisect.bisect_right(sorted_values, value) / len(sorted_values) - q)
+
+
+@pytest.mark.parametrize("n", [50, 1_000, 10_000, 100_000])
+def test_hll_count_within_bound(n):
+    values = [f"invoice-{i}" for i in range(n)]
+    hll = HyperLogLog().update(values)
+    assert abs(hll.count() - len(set(values))) / n <= HLL_BOUND
+
+
+def test_hll_small_sets_are_exact():
+    hll = HyperLogLog().update(["536365", "536366", "536365", "536367"])
+    assert hll.count() == 3
+
+
+def test_hll_merge_equals_union():
+    left_values = [f"sku-{i}" for i in range(0, 6_000)]
+    right_values = [f"sku-{i}" for i in range(4_000, 9_000)]
+    merged = HyperLogLog().update(left_values).merge(HyperLogLog().update(right_values))
+    union = HyperLogLog().update(left_values + right_values)
+    assert merged.to_dict() == union.to_dict()
+    assert merged.count() == union.count()
+
+
+def test_hll_sparse_merge_into_dense():
+    dense = HyperLogLog().update(f"a-{i}" for i in range(5_000))
+    sparse = HyperLogLog().update(f"b-{i}" for i in range(20))
+    assert "sparse" in sparse.to_dict()
+    merged = json_round_trip(dense).merge(sparse)
+    union = HyperLogLog().update([f"a-{i}" for i in range(5_000)] + [f"b-{i}" for i in range(20)])
+    assert merged.to_dict() == union.to_dict()
+
+
+def test_hll_merge_rejects_different_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(p=10).merge(HyperLogLog(p=12))
+
+
+@pytest.mark.parametrize("n, layout", [(30, "sparse"), (20_000, "registers")])
+def test_hll_json_round_trip(n, layout):
+    hll = HyperLogLog().update(f"v-{i}" for i in range(n))
+    assert layout in hll.to_dict()
+    restored = json_round_trip(hll)
+    assert restored.to_dict() == hll.to_dict()
+    assert restored.count() == hll.count()
+
+
+def test_hll_from_dict_rejects_truncated_registers():
+    state = HyperLogLog().update(f"v-{i}" for i in range(20_000)).to_dict()
+    state["registers"] = state["registers"][:-8]
+    with pytest.raises(ValueError):
+        HyperLogLog.from_dict(state)
+
+
+def test_hll_from_dict_rejects_out_of_range_sparse_register():
+    state = {"type": "hll", "p": 12, "sparse": {"4096": 1}}
+    with pytest.raises(ValueError):
+        HyperLogLog.from_dict(state)
+
+
+def test_kll_quantiles_within_rank_bound():
+    rng = random.Random(7)
+    values = [rng.lognormvariate(6, 1.2) for _ in range(50_000)]
+    kll = KLLSketch(seed=0).update(values)
+    exact = sorted(values)
+    for q in QUANTILES:
+        assert rank_error(exact, kll.quantile(q), q) <= KLL_RANK_BOUND
+
+
+def test_kll_small_inputs_are_exact():
+    kll = KLLSketch(seed=0).update(range(1, 101))
+    assert kll.quantile(0.5) == 50
+    assert kll.quantile(0.9) == 90
+
+
+def test_kll_merge_matches_concatenation():
+    rng = random.Random(11)
+    shards = [[rng.expovariate(1 / 300) for _ in range(10_000)] for _ in range(4)]
+    merged = KLLSketch(seed=0)
+    for i, shard in enumerate(shards):
+        merged.merge(json_round_trip(KLLSketch(seed=i).update(shard)))
+
+    concatenated = [value for shard in shards for value in shard]
+    exact = sorted(concatenated)
+    assert merged.n == len(concatenated)
+    for q in QUANTILES:
+        assert rank_error(exact, merged.quantile(q), q) <= KLL_RANK_BOUND
+
+
+def test_kll_merge_rejects_different_k():
+    with pytest.raises(ValueError):
+        KLLSketch(k=100).merge(KLLSketch(k=200))
+
+
+def test_kll_json_round_trip_keeps_state():
+    kll = KLLSketch(seed=3).update(float(i) for i in range(5_000))
+    restored = json_round_trip(kll)
+    assert restored.n == kll.n == 5_000
+    assert restored.compactors == kll.compactors
+    for q in QUANTILES:
+        assert restored.quantile(q) == kll.quantile(q)
+
+
+def test_kll_reloaded_sketch_continues_like_the_original():
+    rng = random.Random(5)
+    first_half = [rng.random() for _ in range(5_000)]
+    second_half = [rng.random() for _ in range(5_000)]
+    original = KLLSketch(seed=3).update(first_half)
+    reloaded = json_round_trip(original)
+    original.update(second_half)
+    reloaded.update(second_half)
+    assert reloaded.to_dict() == original.to_dict()
+
+
+@pytest.mark.parametrize("field, value", [
+    ("n", 4_999),
+    ("k", 1),
+    ("compactors", []),
+    ("compactors", [["not a number"]]),
+    ("flips", -1),
+    ("seed", "0"),
+])
+def test_kll_from_dict_rejects_invalid_state(field, value):
+    state = KLLSketch(seed=0).update(float(i) for i in range(5_000)).to_dict()
+    state[field] = value
+    with pytest.raises(ValueError):
+        KLLSketch.from_dict(state)
+
+
+def test_merge_sketch_states_does_not_modify_right():
+    left = {"12347": {"Invoices": HyperLogLog().update(["1"])}}
+    right = {"12348": {"Invoices": HyperLogLog().update(["2"])}}
+    merge_sketch_states(left, right)
+    left["12348"]["Invoices"].update(["3", "4"])
+    assert right["12348"]["Invoices"].count() == 1
+    assert left["12348"]["Invoices"].count() == 3
+
+
+def test_save_load_and_merge_sketch_states(tmp_path):
+    path = str(tmp_path / "customer_sketches.json")
+    shard_a = {"12347": {"Invoices": HyperLogLog().update(["1", "2"])}}
+    shard_b = {
+        "12347": {"Invoices": HyperLogLog().update(["2", "3"])},
+        "12348": {"Invoices": HyperLogLog().update(["4"])},
+    }
+    save_sketch_states(shard_b, path, metadata={"num_customers": 2})
+    loaded, metadata = load_sketch_states(path)
+
+    merged = merge_sketch_states(shard_a, loaded)
+    assert metadata == {"num_customers": 2}
+    assert merged["12347"]["Invoices"].count() == 3
+    assert merged["12348"]["Invoices"].count() == 1
+
+
+def test_load_sketch_states_rejects_other_files(tmp_path):
+    path = tmp_path / "customer_segments.json"
+    path.write_text(json.dumps({"0": {"Invoices": HyperLogLog().to_dict()}}))
+    with pytest.raises(ValueError):
+        load_sketch_states(str(path))
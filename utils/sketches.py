@@ -0,0 +1,334 @@
+import base64
+import hashlib
+import json
+import math
+import random
+
+# Mergeable sketches for the optional sketch-backed summaries.
+#
+# Error bounds (checked against exact results in tests/test_sketches.py):
+#   * HyperLogLog, p=12 (4096 registers): relative standard error 1.04 / sqrt(2**p),
+#     about 1.6%, and estimates stay within 3 standard errors (about 5%).
+#     Counts use Ertl's improved estimator, which has no bias bump where
+#     classic HyperLogLog switches away from linear counting (~10k values).
+#     Sets of a few hundred values, such as per-customer invoices, are close to exact.
+#   * KLL, k=200: normalized rank error typically under 1%, at most about 2%.
+#     A reported p90 sits between the exact p88 and p92.
+# Merging loses no accuracy beyond these bounds, so states built per chunk,
+# shard or run can be combined without the raw values. HyperLogLog merges are
+# idempotent, but KLL merges add up counts, so merged KLL states must come from
+# disjoint sets of values.
+
+DEFAULT_HLL_PRECISION = 12
+DEFAULT_KLL_K = 200
+
+
+def _sigma(x):
+    if x == 1:
+        return math.inf
+    y = 1.0
+    z = x
+    while True:
+        x *= x
+        previous = z
+        z += x * y
+        y += y
+        if z == previous:
+            return z
+
+
+def _tau(x):
+    if x == 0 or x == 1:
+        return 0.0
+    y = 1.0
+    z = 1 - x
+    while True:
+        x = math.sqrt(x)
+        previous = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+
+class HyperLogLog:
+    """
+    Approximate distinct counter with constant memory per group.
+    Registers are kept sparse until a quarter of them are set, so small
+    per-customer sets stay cheap to hold and to merge.
+    """
+
+    def __init__(self, p=DEFAULT_HLL_PRECISION):
+        if not 4 <= p <= 16:
+            raise ValueError(f"HyperLogLog precision must be between 4 and 16, got {p}")
+        self.p = p
+        self.m = 1 << p
+        self.registers = None
+        self._sparse = {}
+
+    def _set(self, idx, rank):
+        if self.registers is not None:
+            if rank > self.registers[idx]:
+                self.registers[idx] = rank
+        elif rank > self._sparse.get(idx, 0):
+            self._sparse[idx] = rank
+            if len(self._sparse) >= self.m // 4:
+                self._densify()
+
+    def _densify(self):
+        self.registers = bytearray(self.m)
+        for idx, rank in self._sparse.items():
+            self.registers[idx] = rank
+        self._sparse = {}
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+        x = int.from_bytes(digest, "big")
+        idx = x >> (64 - self.p)
+        w = x & ((1 << (64 - self.p)) - 1)
+        self._set(idx, (64 - self.p) - w.bit_length() + 1)
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        if self.p != other.p:
+            raise ValueError(f"Cannot merge HyperLogLog sketches with precision {self.p} and {other.p}")
+        if other.registers is None:
+            for idx, rank in other._sparse.items():
+                self._set(idx, rank)
+        else:
+            if self.registers is None:
+                self._densify()
+            self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        # Ertl's improved estimator: unbiased across the whole range, with no
+        # switch-over between linear counting and the raw estimate
+        q = 64 - self.p
+        histogram = [0] * (q + 2)
+        if self.registers is None:
+            histogram[0] = self.m - len(self._sparse)
+            for rank in self._sparse.values():
+                histogram[rank] += 1
+        else:
+            for rank in self.registers:
+                histogram[rank] += 1
+
+        if histogram[0] == self.m:
+            return 0
+        z = self.m * _tau(1 - histogram[q + 1] / self.m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + histogram[k])
+        z += self.m * _sigma(histogram[0] / self.m)
+        return int(round(self.m * self.m / (2 * math.log(2) * z)))
+
+    def to_dict(self):
+        if self.registers is None:
+            return {
+                "type": "hll",
+                "p": self.p,
+                "sparse": {str(idx): rank for idx, rank in self._sparse.items()},
+            }
+        return {
+            "type": "hll",
+            "p": self.p,
+            "registers": base64.b64encode(bytes(self.registers)).decode("ascii"),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(p=state["p"])
+        max_rank = 64 - sketch.p + 1
+        if "registers" in state:
+            registers = bytearray(base64.b64decode(state["registers"]))
+            if len(registers) != sketch.m:
+                raise ValueError(
+                    f"HyperLogLog state has {len(registers)} registers, expected {sketch.m} for p={sketch.p}"
+                )
+            if max(registers) > max_rank:
+                raise ValueError(f"HyperLogLog state has a register rank above {max_rank}")
+            sketch.registers = registers
+        else:
+            for idx, rank in state["sparse"].items():
+                idx = int(idx)
+                if not 0 <= idx < sketch.m or not 0 < rank <= max_rank:
+                    raise ValueError(f"Invalid HyperLogLog sparse register {idx}: {rank}")
+                sketch._set(idx, rank)
+        return sketch
+
+
+class KLLSketch:
+    """Approximate quantiles (Karnin-Lang-Liberty) with constant memory per group."""
+
+    def __init__(self, k=DEFAULT_KLL_K, seed=None):
+        if isinstance(k, bool) or not isinstance(k, int) or k < 2:
+            raise ValueError(f"KLL k must be an integer of at least 2, got {k!r}")
+        self.k = k
+        self.n = 0
+        self.compactors = [[]]
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.flips = 0
+
+    def _coin(self):
+        # Coin flips are derived from (seed, flips), so a reloaded sketch
+        # carries on with the same flips it would have made unserialized
+        self.flips += 1
+        digest = hashlib.blake2b(f"{self.seed}:{self.flips}".encode("utf-8"), digest_size=1).digest()
+        return digest[0] & 1
+
+    def _capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(2, int(math.ceil(self.k * (2 / 3) ** depth)))
+
+    def _size(self):
+        return sum(len(c) for c in self.compactors)
+
+    def _max_size(self):
+        return sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _compress(self):
+        while self._size() >= self._max_size():
+            for h, items in enumerate(self.compactors):
+                if len(items) >= self._capacity(h):
+                    if h + 1 == len(self.compactors):
+                        self.compactors.append([])
+                    items.sort()
+                    # Keep the odd item at this level so weights stay exact
+                    leftover = [items.pop()] if len(items) % 2 else []
+                    offset = self._coin()
+                    self.compactors[h + 1].extend(items[offset::2])
+                    self.compactors[h] = leftover
+                    break
+
+    def add(self, value):
+        self.compactors[0].append(float(value))
+        self.n += 1
+        if len(self.compactors[0]) >= self._capacity(0):
+            self._compress()
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        if self.k != other.k:
+            raise ValueError(f"Cannot merge KLL sketches with k={self.k} and k={other.k}")
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for h, items in enumerate(other.compactors):
+            self.compactors[h].extend(items)
+        self.n += other.n
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        if not 0 <= q <= 1:
+            raise ValueError(f"Quantile must be between 0 and 1, got {q}")
+        if self.n == 0:
+            return float("nan")
+
+        weighted = sorted(
+            (value, 2 ** h) for h, items in enumerate(self.compactors) for value in items
+        )
+        target = q * self.n
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= target:
+                return value
+        return weighted[-1][0]
+
+    def to_dict(self):
+        return {
+            "type": "kll",
+            "k": self.k,
+            "n": self.n,
+            "seed": self.seed,
+            "flips": self.flips,
+            "compactors": self.compactors,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        if isinstance(state["seed"], bool) or not isinstance(state["seed"], int):
+            raise ValueError(f"KLL state has an invalid seed: {state['seed']!r}")
+        sketch = cls(k=state["k"], seed=state["seed"])
+        compactors = state["compactors"]
+        if not isinstance(compactors, list) or not compactors:
+            raise ValueError("KLL state must have at least one compactor")
+        for items in compactors:
+            if not isinstance(items, list) or not all(
+                isinstance(v, (int, float)) and not isinstance(v, bool) for v in items
+            ):
+                raise ValueError("KLL compactors must be lists of numbers")
+
+        weight = sum(len(items) * 2 ** h for h, items in enumerate(compactors))
+        if state["n"] != weight:
+            raise ValueError(f"KLL state has n={state['n']} but its compactors hold weight {weight}")
+        flips = state["flips"]
+        if isinstance(flips, bool) or not isinstance(flips, int) or flips < 0:
+            raise ValueError(f"KLL state has an invalid flip count: {flips!r}")
+
+        sketch.n = state["n"]
+        sketch.flips = flips
+        sketch.compactors = [[float(v) for v in items] for items in compactors]
+        return sketch
+
+
+def sketch_from_dict(state):
+    if state["type"] == "hll":
+        return HyperLogLog.from_dict(state)
+    if state["type"] == "kll":
+        return KLLSketch.from_dict(state)
+    raise ValueError(f"Unknown sketch type: {state['type']}")
+
+
+def merge_sketch_states(left, right):
+    """
+    Merges two {group: {metric: sketch}} mappings in place into `left`.
+    Groups and metrics missing from `left` are copied over, so `right` is never modified.
+    """
+    for group, sketches in right.items():
+        target = left.setdefault(group, {})
+        for name, sketch in sketches.items():
+            if name in target:
+                target[name].merge(sketch)
+            else:
+                target[name] = type(sketch).from_dict(sketch.to_dict())
+    return left
+
+
+def save_sketch_states(states, path, metadata=None):
+    """
+    Saves {group: {metric: sketch}} states as JSON. `metadata` records where the
+    states came from so readers can detect a stale file.
+    """
+    payload = {
+        "metadata": metadata or {},
+        "states": {
+            str(group): {name: sketch.to_dict() for name, sketch in sketches.items()}
+            for group, sketches in states.items()
+        },
+    }
+    with open(path, "w") as f:
+        json.dump(payload, f)
+
+
+def load_sketch_states(path):
+    """
+    Loads states saved by save_sketch_states and returns (states, metadata).
+    """
+    with open(path) as f:
+        payload = json.load(f)
+    if not isinstance(payload, dict) or set(payload) != {"metadata", "states"}:
+        raise ValueError(f"{path} is not a sketch state file")
+    states = {
+        group: {name: sketch_from_dict(state) for name, state in sketches.items()}
+        for group, sketches in payload["states"].items()
+    }
+    return states, payload["metadata"]